@@ -43,9 +43,11 @@ import sys
 import signal
 import logging
 import socket
+import hashlib
+import random
+import tempfile
+import time
 from datetime import datetime
-from time import time, sleep
-from random import randint
 
 import dateutil.parser
 from wheel import pep425tags
@@ -71,7 +73,15 @@ class PiWheelsSlave:
 
     .. _PyPI: https://pypi.python.org/
     """
-    def __init__(self):
+    _parser = None
+
+    def __init__(self, *, clock=time.monotonic, sleep=time.sleep,
+                 rng=random):
+        # The clock, sleep, and random number source are parameters so the
+        # test suite can provide deterministic ones
+        self._clock = clock
+        self._sleep = sleep
+        self._rng = rng
         self.logger = logging.getLogger('slave')
         self.label = socket.gethostname()
         self.config = None
@@ -79,40 +89,68 @@ class PiWheelsSlave:
         self.builder = None
         self.pypi_url = None
         self.systemd = None
-
-    def __call__(self, args=None):
-        sys.excepthook = terminal.error_handler
-        parser = terminal.configure_parser("""
+        self.file_queue = None
+        self.impl_tag = None
+        self.abi_tag = None
+        self.platform_tag = None
+        self.staging_dir = None
+
+    @classmethod
+    def get_parser(cls):
+        """
+        Return the argument parser for :program:`piw-slave`. The parser is
+        only constructed on the first call; subsequent calls (e.g. from
+        other instances) return the same parser.
+        """
+        if cls._parser is None:
+            parser = terminal.configure_parser("""
 The piw-slave script is intended to be run on a standalone machine to build
 packages on behalf of the piw-master script. It is intended to be run as an
 unprivileged user with a clean home-directory. Any build dependencies you wish
 to use must already be installed. The script will run until it is explicitly
 terminated, either by Ctrl+C, SIGTERM, or by the remote piw-master script.
 """)
-        parser.add_argument(
-            '--debug', action='store_true', help="Set logging to debug level")
-        parser.add_argument(
-            '-m', '--master', env_var='PIW_MASTER', metavar='HOST',
-            default='localhost',
-            help="The IP address or hostname of the master server "
-            "(default: %(default)s)")
-        parser.add_argument(
-            '-t', '--timeout', env_var='PIW_TIMEOUT', metavar='DURATION',
-            default='3h', type=duration,
-            help="The time to wait before assuming a build has failed "
-            "(default: %(default)s)")
-        self.config = parser.parse_args(args)
+            parser.add_argument(
+                '--debug', action='store_true',
+                help="Set logging to debug level")
+            parser.add_argument(
+                '-m', '--master', env_var='PIW_MASTER', metavar='HOST',
+                default='localhost',
+                help="The IP address or hostname of the master server "
+                "(default: %(default)s)")
+            parser.add_argument(
+                '-t', '--timeout', env_var='PIW_TIMEOUT', metavar='DURATION',
+                default='3h', type=duration,
+                help="The time to wait before assuming a build has failed "
+                "(default: %(default)s)")
+            cls._parser = parser
+        return cls._parser
+
+    def __call__(self, args=None):
+        sys.excepthook = terminal.error_handler
+        self.config = self.get_parser().parse_args(args)
         if self.config.debug:
             self.config.log_level = logging.DEBUG
         terminal.configure_logging(self.config.log_level,
                                    self.config.log_file)
 
         self.logger.info('PiWheels Slave version %s', __version__)
+        if not hashlib.sha256.__name__.startswith('openssl_'):
+            self.logger.warning(
+                'hashlib is not backed by OpenSSL; wheel hashing will be slow')
         if os.geteuid() == 0:
             self.logger.error('Slave must not be run as root')
             return 1
         self.systemd = get_systemd()
         signal.signal(signal.SIGTERM, sig_term)
+        # The PEP 425 tags are invariant for the life of the process; there's
+        # no need to re-calculate them every time we (re-)connect to the master
+        self.impl_tag = pep425tags.get_impl_ver()
+        self.abi_tag = pep425tags.get_abi_tag()
+        self.platform_tag = pep425tags.get_platform()
+        # All builds are staged within a single directory for the life of the
+        # process; anything a build leaves behind is removed when we exit
+        self.staging_dir = tempfile.TemporaryDirectory(prefix='piw-stage-')
         ctx = transport.Context()
         queue = None
         try:
@@ -138,6 +176,9 @@ terminated, either by Ctrl+C, SIGTERM, or by the remote piw-master script.
                         self.logger.warning('Discarding current build')
                         self.builder.clean()
                         self.builder = None
+                    if self.file_queue is not None:
+                        self.file_queue.close()
+                        self.file_queue = None
         except SystemExit:
             self.logger.warning('Shutting down on SIGTERM')
         finally:
@@ -145,6 +186,7 @@ terminated, either by Ctrl+C, SIGTERM, or by the remote piw-master script.
             queue.send_msg('BYE')
             queue.close()
             ctx.close()
+            self.staging_dir.cleanup()
 
     # A general note about the design of the slave: the build slave is
     # deliberately designed to be "brittle". In other words to fall over and
@@ -166,22 +208,28 @@ terminated, either by Ctrl+C, SIGTERM, or by the remote piw-master script.
         are exceeded.
         """
         msg, data = 'HELLO', [
-            self.config.timeout,
-            pep425tags.get_impl_ver(), pep425tags.get_abi_tag(),
-            pep425tags.get_platform(), self.label
+            self.config.timeout, self.impl_tag, self.abi_tag,
+            self.platform_tag, self.label
         ]
-        while True:
-            queue.send_msg(msg, data)
-            start = time()
+        # Register the queue with a poller once, rather than have every poll
+        # construct (and tear down) a temporary one
+        poller = transport.Poller()
+        poller.register(queue, transport.POLLIN)
+        try:
             while True:
-                self.systemd.watchdog_ping()
-                if queue.poll(1):
-                    msg, data = queue.recv_msg()
-                    msg, data = self.handle_reply(msg, data)
-                    break
-                elif time() - start > timeout:
-                    self.logger.warning('Timed out waiting for master')
-                    raise MasterTimeout()
+                queue.send_msg(msg, data)
+                start = self._clock()
+                while True:
+                    self.systemd.watchdog_ping()
+                    if poller.poll(1):
+                        msg, data = queue.recv_msg()
+                        msg, data = self.handle_reply(msg, data)
+                        break
+                    elif self._clock() - start > timeout:
+                        self.logger.warning('Timed out waiting for master')
+                        raise MasterTimeout()
+        finally:
+            poller.unregister(queue)
 
     def handle_reply(self, msg, data):
         """
@@ -222,7 +270,7 @@ terminated, either by Ctrl+C, SIGTERM, or by the remote piw-master script.
         """
         assert self.slave_id is not None, 'SLEEP before ACK'
         self.logger.info('No available jobs; sleeping')
-        sleep(randint(5, 15))
+        self._sleep(self._rng.randint(5, 15))
         return 'IDLE', protocols.NoData
 
     def do_build(self, package, version):
@@ -235,7 +283,8 @@ terminated, either by Ctrl+C, SIGTERM, or by the remote piw-master script.
         assert self.slave_id is not None, 'BUILD before ACK'
         assert not self.builder, 'Last build still exists'
         self.logger.warning('Building package %s version %s', package, version)
-        self.builder = PiWheelsBuilder(package, version)
+        self.builder = PiWheelsBuilder(package, version,
+                                       self.staging_dir.name)
         if self.builder.build(self.config.timeout, self.pypi_url):
             self.logger.info('Build succeeded')
         else:
@@ -254,17 +303,18 @@ terminated, either by Ctrl+C, SIGTERM, or by the remote piw-master script.
         assert self.slave_id is not None, 'SEND before ACK'
         assert self.builder, 'Send before build / after failed build'
         assert self.builder.status, 'Send after failed build'
-        pkg = [f for f in self.builder.files if f.filename == filename][0]
+        pkg = self.builder.files_by_name[filename]
         self.logger.info(
             'Sending %s to master on %s', pkg.filename, self.config.master)
-        ctx = transport.Context()
-        queue = ctx.socket(transport.DEALER, logger=self.logger)
-        queue.hwm = 10
-        queue.connect('tcp://{master}:5556'.format(master=self.config.master))
-        try:
-            pkg.transfer(queue, self.slave_id)
-        finally:
-            queue.close()
+        # The file transfer socket is kept open for the life of the connection
+        # to the master, rather than re-connected for every file
+        if self.file_queue is None:
+            ctx = transport.Context()
+            self.file_queue = ctx.socket(transport.DEALER, logger=self.logger)
+            self.file_queue.hwm = 10
+            self.file_queue.connect(
+                'tcp://{master}:5556'.format(master=self.config.master))
+        pkg.transfer(self.file_queue, self.slave_id)
         return 'SENT', protocols.NoData
 
     def do_done(self):
@@ -36,18 +36,24 @@ Defines the classes which use ``pip`` to build wheels.
     :members:
 """
 
+import io
 import os
 import re
+import mmap
+import shutil
 import zipfile
 import hashlib
 import resource
 import tempfile
 import warnings
 import email.parser
+from time import monotonic
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import timedelta
+from threading import Timer, Lock
 from subprocess import Popen, DEVNULL, PIPE, TimeoutExpired
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import apt
@@ -57,6 +63,12 @@ except ImportError:
 from ..systemd import get_systemd
 
 
+# Used to calculate the (independent) hashes and dependencies of packages
+# simultaneously; hashlib releases the GIL while hashing large buffers, and the
+# dependency calculation spends most of its time waiting on ldd
+_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+
 class PiWheelsPackage:
     """
     Records the state of a build artifact, i.e. a wheel package. The filename
@@ -65,7 +77,11 @@ class PiWheelsPackage:
     :param pathlib.Path path:
         The path to the wheel on the local filesystem.
     """
-    apt_cache = None
+    apt_files = None
+    apt_conflicts = None
+    apt_lock = Lock()
+    ldd_timeout = 60
+    ldd_re = re.compile(r'\s*(.*)\s=>\s(/.*)\s\(0x[0-9a-fA-F]+\)$')
 
     def __init__(self, path):
         self.systemd = get_systemd()
@@ -74,6 +90,8 @@ class PiWheelsPackage:
         self._filehash = None
         self._metadata = None
         self._dependencies = None
+        self._zip = None
+        self._zip_file = None
         self._parts = list(path.stem.split('-'))
         # Fix up retired tags (noabi->none)
         if self._parts[-2] == 'noabi':
@@ -84,16 +102,18 @@ class PiWheelsPackage:
         Return the state as a list suitable for use in the ``BUILT`` message
         of :program:`piw-slave`.
         """
+        filehash = _EXECUTOR.submit(lambda: self.filehash)
+        dependencies = self.dependencies
         return (
             self.filename,
             self.filesize,
-            self.filehash,
+            filehash.result(),
             self.package_tag,
             self.package_version_tag,
             self.py_version_tag,
             self.abi_tag,
             self.platform_tag,
-            self.dependencies
+            dependencies
         )
 
     @property
@@ -117,14 +137,23 @@ class PiWheelsPackage:
         Return an SHA256 digest of the wheel's contents.
         """
         if self._filehash is None:
-            s = hashlib.sha256()
-            with self.wheel_file.open('rb') as f:
-                while True:
-                    buf = f.read(65536)
-                    if buf:
-                        s.update(buf)
-                    else:
-                        break
+            with self.open() as f:
+                try:
+                    file_digest = hashlib.file_digest
+                except AttributeError:
+                    # Python < 3.11; read into a single re-usable buffer to
+                    # avoid allocating a new bytes object for every chunk
+                    s = hashlib.sha256()
+                    buf = bytearray(65536)
+                    view = memoryview(buf)
+                    while True:
+                        size = f.readinto(buf)
+                        if size:
+                            s.update(view[:size])
+                        else:
+                            break
+                else:
+                    s = file_digest(f, 'sha256')
             self._filehash = s.hexdigest().lower()
         return self._filehash
 
@@ -182,64 +211,152 @@ class PiWheelsPackage:
         """
         return self.wheel_file.open('rb')
 
+    @property
+    def zip(self):
+        """
+        Return a :class:`zipfile.ZipFile` for the wheel. This is opened on
+        first access and re-used (saving re-reading the central directory)
+        until :meth:`close` is called.
+        """
+        if self._zip is None:
+            self._zip_file = self.open()
+            self._zip = zipfile.ZipFile(self._zip_file)
+        return self._zip
+
+    def close(self):
+        """
+        Close the wheel's archive, if :attr:`zip` opened it.
+        """
+        if self._zip is not None:
+            self._zip.close()
+            self._zip_file.close()
+            self._zip = None
+            self._zip_file = None
+
     @property
     def metadata(self):
         """
-        Return the contents of the :file:`METADATA` file inside the wheel.
+        Return the headers of the :file:`METADATA` file inside the wheel.
+        The message body (typically the long description) is not parsed.
         """
         if self._metadata is None:
-            with zipfile.ZipFile(self.open()) as wheel:
-                filename = (
-                    '{self.package_tag}-'
-                    '{self.package_version_tag}.dist-info/'
-                    'METADATA'.format(self=self)
-                )
-                with wheel.open(filename) as metadata:
-                    parser = email.parser.BytesParser()
-                    self._metadata = parser.parse(metadata)
+            filename = (
+                '{self.package_tag}-'
+                '{self.package_version_tag}.dist-info/'
+                'METADATA'.format(self=self)
+            )
+            with self.zip.open(filename) as metadata:
+                parser = email.parser.BytesHeaderParser()
+                self._metadata = parser.parse(metadata)
         return self._metadata
 
     def _calculate_apt_dependencies(self):
-        if PiWheelsPackage.apt_cache is None:
-            PiWheelsPackage.apt_cache = apt.cache.Cache()
-        cache = PiWheelsPackage.apt_cache
-        find_re = re.compile(r'^\s*(.*)\s=>\s(/.*)\s\(0x[0-9a-fA-F]+\)$')
+        # Several packages' dependencies may be calculated at once, but the
+        # index only needs building by one of them
+        with PiWheelsPackage.apt_lock:
+            if PiWheelsPackage.apt_files is None:
+                # Build a reverse index of installed shared object to
+                # providing package once; walking the whole apt cache for
+                # every library is prohibitively slow. Files claimed by
+                # several packages (diversions, usrmerge aliases) are recorded
+                # separately so a dependency on one can still fail loudly
+                # below
+                apt_files = {}
+                apt_conflicts = set()
+                for pkg in apt.cache.Cache():
+                    if pkg.installed is not None:
+                        for filename in pkg.installed_files:
+                            if '.so' in filename and apt_files.setdefault(
+                                    filename, pkg.name) != pkg.name:
+                                apt_conflicts.add(filename)
+                PiWheelsPackage.apt_files = apt_files
+                PiWheelsPackage.apt_conflicts = apt_conflicts
+            apt_files = PiWheelsPackage.apt_files
+            apt_conflicts = PiWheelsPackage.apt_conflicts
         deps = defaultdict(set)
         libs = set()
         with tempfile.TemporaryDirectory() as tempdir:
-            with zipfile.ZipFile(self.open()) as wheel:
-                for info in wheel.infolist():
-                    if info.filename.endswith('.so') or '.so.' in info.filename:
-                        with wheel.open(info) as testfile:
-                            is_elf = testfile.read(4) == b'\x7FELF'
-                        if is_elf:
-                            libs.add(wheel.extract(info, path=tempdir))
-            for lib in libs:
-                p = Popen(['ldd', lib], stdout=PIPE, stderr=DEVNULL)
+            wheel = self.zip
+            for info in wheel.infolist():
+                # Ignore anything too small to hold an ELF header, and any
+                # libraries that only exist for the package's test-suite
+                if info.file_size < 52 or not {'test', 'tests'}.isdisjoint(
+                        info.filename.lower().split('/')[:-1]):
+                    continue
+                if info.filename.endswith('.so') or '.so.' in info.filename:
+                    # Check the magic number and, for ELF files, copy the
+                    # rest of the stream straight out to a flat temporary file
+                    # (in 1MB chunks) so each library is only decompressed
+                    # once, and no directory structure needs creating
+                    with wheel.open(info) as member:
+                        magic = member.read(4)
+                        if magic == b'\x7FELF':
+                            with tempfile.NamedTemporaryFile(
+                                    dir=tempdir, suffix='.so',
+                                    delete=False) as lib:
+                                lib.write(magic)
+                                shutil.copyfileobj(member, lib, 1024 * 1024)
+                            libs.add(lib.name)
+            if libs:
+                # ldd accepts multiple files, so split the libraries into a
+                # shard per CPU and query each shard with a single ldd, all
+                # running concurrently; the "filename:" header ldd outputs
+                # before each library's dependencies is simply ignored by
+                # ldd_re
+                libs = sorted(libs)
+                shards = min(len(libs), os.cpu_count() or 1)
+                procs = []
+
+                def kill():
+                    for p in procs:
+                        p.kill()
+
+                # All the ldd processes share a single budget for the wheel;
+                # if they take too long the timer kills them, which simply
+                # ends their output early
+                timer = Timer(self.ldd_timeout, kill)
+                timer.start()
                 try:
-                    out, errs = p.communicate(timeout=10)
-                except TimeoutExpired:
-                    p.kill()
-                    out, errs = p.communicate()
+                    for shard in range(shards):
+                        procs.append(Popen(
+                            ['ldd'] + libs[shard::shards],
+                            stdout=PIPE, stderr=DEVNULL))
+                    # Parse each ldd's output line by line as it is produced
+                    # rather than buffering all of it; the others continue
+                    # running (or block on a full pipe) in the meantime
+                    for p in procs:
+                        with io.TextIOWrapper(p.stdout, encoding='ascii',
+                                              errors='replace') as out:
+                            for line in out:
+                                match = self.ldd_re.match(line)
+                                if match is not None:
+                                    try:
+                                        lib_path = str(
+                                            Path(match.group(2)).resolve())
+                                    except FileNotFoundError:
+                                        continue
+                                    assert lib_path not in apt_conflicts, (
+                                        'multiple packages provide %s' %
+                                        lib_path)
+                                    try:
+                                        deps['apt'].add(apt_files[lib_path])
+                                    except KeyError:
+                                        deps[''].add(lib_path)
+                                    self.systemd.watchdog_ping()
                 finally:
-                    out = out.decode('ascii', 'replace')
-                    for line in out.splitlines():
-                        match = find_re.search(line)
-                        if match is not None:
-                            try:
-                                lib_path = str(Path(match.group(2)).resolve())
-                            except FileNotFoundError:
-                                continue
-                            providers = {
-                                pkg.name for pkg in cache
-                                if pkg.installed is not None
-                                and lib_path in pkg.installed_files}
-                            assert len(providers) <= 1
-                            try:
-                                deps['apt'].add(providers.pop())
-                            except KeyError:
-                                deps[''].add(lib_path)
-                            self.systemd.watchdog_ping()
+                    timer.cancel()
+                    # If parsing was interrupted nothing will read the
+                    # remaining shards' output, so kill them and close their
+                    # pipes; otherwise any ldd with more than a pipe-full of
+                    # output would block forever and so would the wait. On
+                    # the normal path every shard has already exited so this
+                    # does nothing
+                    for p in procs:
+                        if p.returncode is None:
+                            p.kill()
+                        p.stdout.close()
+                    for p in procs:
+                        p.wait()
         return {tool: sorted(deps) for tool, deps in deps.items()}
 
     @property
@@ -260,6 +377,17 @@ class PiWheelsPackage:
         implementation of the :class:`.file_juggler.FileJuggler` protocol.
         """
         with self.open() as f:
+            try:
+                # Map the wheel so each FETCH can be answered with a slice of
+                # it, avoiding a seek and read (and a copy) per chunk. The map
+                # is deliberately not closed explicitly; 0MQ may still hold
+                # references to slices of it when we return, so it's left to
+                # be unmapped when the last of those is released
+                buf = memoryview(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except (io.UnsupportedOperation, ValueError):
+                # Not a real file, or an empty one which can't be mapped
+                buf = memoryview(f.read())
             timeout = 0
             while True:
                 if not queue.poll(timeout):
@@ -280,8 +408,12 @@ class PiWheelsPackage:
                         return
                     elif req == b'FETCH':
                         offset, size = args
-                        f.seek(int(offset))
-                        queue.send_multipart([b'CHUNK', offset, f.read(int(size))])
+                        start = int(offset)
+                        # Chunks are large enough that it's worth letting 0MQ
+                        # reference the buffer instead of copying it
+                        queue.send_multipart(
+                            [b'CHUNK', offset, buf[start:start + int(size)]],
+                            copy=False)
 
 
 class PiWheelsBuilder:
@@ -293,22 +425,34 @@ class PiWheelsBuilder:
 
     :param str version:
         The version of the package to attempt to build.
+
+    :param str staging_dir:
+        The directory in which to create the build's temporary directory. If
+        this is :data:`None` (the default), the system's temporary directory
+        is used.
     """
-    def __init__(self, package, version):
+    def __init__(self, package, version, staging_dir=None):
         self.systemd = get_systemd()
+        self.staging_dir = staging_dir
         self.wheel_dir = None
         self.package = package
         self.version = version
         self.duration = None
         self.output = ''
         self.files = []
+        self.files_by_name = {}
         self.status = False
+        self._pending = []
 
     def as_message(self):
         """
         Return the state as a list suitable for use in the ``BUILT`` message
         of :program:`piw-slave`.
         """
+        # Wait for (and raise any errors from) the background calculations
+        # started by build
+        for future in self._pending:
+            future.result()
         return [
             self.package, self.version, self.status, self.duration,
             self.output, [pkg.as_message() for pkg in self.files]
@@ -319,15 +463,15 @@ class PiWheelsBuilder:
         """
         Attempt to build the package within the specified *timeout*.
 
-        :param float timeout:
-            The number of seconds to wait for ``pip`` to finish before raising
+        :param datetime.timedelta timeout:
+            The time to wait for ``pip`` to finish before raising
             :exc:`subprocess.TimeoutExpired`.
 
         :param str pypi_index:
             The URL of the :pep:`503` compliant repository from which to fetch
             packages for building.
         """
-        self.wheel_dir = tempfile.TemporaryDirectory()
+        self.wheel_dir = tempfile.TemporaryDirectory(dir=self.staging_dir)
         with tempfile.NamedTemporaryFile('w+', dir=self.wheel_dir.name,
                                          suffix='.log',
                                          encoding='utf-8') as log_file:
@@ -353,7 +497,8 @@ class PiWheelsBuilder:
             # obeying it individually), but it should reduce the incidence of
             # huge C++ compiles killing the build slaves
             resource.setrlimit(resource.RLIMIT_DATA, (1024**3, 1024**3))
-            start = datetime.utcnow()
+            start = monotonic()
+            deadline = start + timeout.total_seconds()
             try:
                 proc = Popen(
                     args,
@@ -371,9 +516,9 @@ class PiWheelsBuilder:
                 while True:
                     self.systemd.watchdog_ping()
                     try:
-                        proc.wait(10)
+                        proc.wait(max(0, min(60, deadline - monotonic())))
                     except TimeoutExpired:
-                        if datetime.utcnow() - start > timeout:
+                        if monotonic() >= deadline:
                             proc.terminate()
                             try:
                                 proc.wait(10)
@@ -386,7 +531,7 @@ class PiWheelsBuilder:
                 error = exc
             else:
                 error = None
-            self.duration = datetime.utcnow() - start
+            self.duration = timedelta(seconds=monotonic() - start)
             self.status = proc.returncode == 0
             if error is not None:
                 log_file.seek(0, os.SEEK_END)
@@ -396,13 +541,24 @@ class PiWheelsBuilder:
 
             if self.status:
                 for path in Path(self.wheel_dir.name).glob('*.whl'):
-                    self.files.append(PiWheelsPackage(path))
+                    pkg = PiWheelsPackage(path)
+                    self.files.append(pkg)
+                    # Start calculating the (slow) hash and dependencies of
+                    # all packages in the background; as_message waits for
+                    # the results
+                    self._pending.append(
+                        _EXECUTOR.submit(getattr, pkg, 'filehash'))
+                    self._pending.append(
+                        _EXECUTOR.submit(getattr, pkg, 'dependencies'))
+                self.files_by_name = {pkg.filename: pkg for pkg in self.files}
             return self.status
 
     def clean(self):
         """
         Remove the temporary build directory and all its contents.
         """
+        for pkg in self.files:
+            pkg.close()
         if self.wheel_dir is not None:
             self.wheel_dir.cleanup()
             self.wheel_dir = None
@@ -214,9 +214,9 @@ class Socket:
         self._logger.debug('<< %s', buf)
         return buf
 
-    def send_multipart(self, msg_parts, flags=0):
+    def send_multipart(self, msg_parts, flags=0, copy=True):
         self._logger.debug('>>' + (' %s' * len(msg_parts)), *msg_parts)
-        return self._socket.send_multipart(msg_parts, flags)
+        return self._socket.send_multipart(msg_parts, flags, copy=copy)
 
     def recv_multipart(self, flags=0):
         msg_parts = self._socket.recv_multipart(flags)
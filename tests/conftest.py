@@ -28,6 +28,8 @@
 
 
 import os
+import uuid
+import select
 from unittest import mock
 from datetime import datetime, timedelta, timezone
 from hashlib import sha256
@@ -342,37 +344,93 @@ def zmq_context(request):
 
 
 @pytest.fixture()
-def mock_context(request, zmq_context, tmpdir):
+def slave_queue_name(request):
+    # The slave tests share the session's context with the slave under test,
+    # so a unique in-process endpoint will do; no need for a socket file
+    yield 'inproc://slave-driver-' + uuid.uuid4().hex
+
+
+@pytest.fixture()
+def file_queue_name(request):
+    yield 'inproc://file-juggler-' + uuid.uuid4().hex
+
+
+@pytest.fixture()
+def mock_context(request, zmq_context, slave_queue_name, file_queue_name):
     with mock.patch('piwheels.transport.Context') as inst_mock:
         ctx_mock = mock.Mock(wraps=zmq_context)
         inst_mock.return_value = ctx_mock
         # Neuter the close() method
         ctx_mock.close = mock.Mock()
         # Override the socket() method so connect calls on the result get
-        # re-directed to local IPC sockets
+        # re-directed to local in-process sockets. The real socket is returned
+        # (with connect overridden) so it can still be registered with pollers.
+        # Every socket created is recorded in ctx_mock.sockets so tests can
+        # check for leaks
+        ctx_mock.sockets = []
         def socket(socket_type, *args, **kwargs):
             sock = zmq_context.socket(socket_type, *args, **kwargs)
+            ctx_mock.sockets.append(sock)
+            sock_connect = sock.connect
             def connect(addr):
                 if addr.startswith('tcp://') and addr.endswith(':5555'):
-                    addr = 'ipc://' + str(tmpdir.join('slave-driver-queue'))
+                    addr = slave_queue_name
                 elif addr.startswith('tcp://') and addr.endswith(':5556'):
-                    addr = 'ipc://' + str(tmpdir.join('file-juggler-queue'))
-                return sock.connect(addr)
-            sock_mock = mock.Mock(wraps=sock)
-            sock_mock.connect = mock.Mock(side_effect=connect)
-            return sock_mock
+                    addr = file_queue_name
+                return sock_connect(addr)
+            sock.connect = connect
+            return sock
         ctx_mock.socket = mock.Mock(side_effect=socket)
         yield ctx_mock
 
 
+class EventFD:
+    """
+    A minimal work-alike for :class:`threading.Event` (without
+    :meth:`~threading.Event.clear`) backed by a Linux eventfd, so waiting is a
+    single :func:`select.select` call rather than a Python-level condition
+    loop.
+    """
+    def __init__(self):
+        self._fd = os.eventfd(0, os.EFD_CLOEXEC | os.EFD_NONBLOCK)
+
+    def close(self):
+        # Daemon threads left behind by a failed test may still call set or
+        # wait after teardown; they must not touch the fd number once the OS
+        # is free to reuse it for something else
+        fd, self._fd = self._fd, -1
+        if fd != -1:
+            os.close(fd)
+
+    def set(self):
+        fd = self._fd
+        if fd != -1:
+            os.eventfd_write(fd, 1)
+
+    def is_set(self):
+        return self.wait(0)
+
+    def wait(self, timeout=None):
+        fd = self._fd
+        if fd == -1:
+            return False
+        return bool(select.select([fd], [], [], timeout)[0])
+
+
 @pytest.fixture()
 def mock_systemd(request):
+    # Fall back to ordinary threading Events where eventfd isn't available
+    # (non-Linux platforms, and Python versions prior to 3.10)
+    event = EventFD if hasattr(os, 'eventfd') else Event
     with mock.patch('piwheels.systemd._SYSTEMD') as sysd_mock:
-        sysd_mock._ready = Event()
+        sysd_mock._ready = event()
         sysd_mock.ready.side_effect = sysd_mock._ready.set
-        sysd_mock._reloading = Event()
+        sysd_mock._reloading = event()
         sysd_mock.reloading.side_effect = sysd_mock._reloading.set
         yield sysd_mock
+        if event is EventFD:
+            sysd_mock._ready.close()
+            sysd_mock._reloading.close()
 
 
 @pytest.fixture(scope='function')
@@ -35,7 +35,7 @@ from unittest import mock
 from pathlib import Path
 from threading import Thread, Event
 from subprocess import TimeoutExpired
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 import pytest
 
@@ -52,6 +52,8 @@ def mock_archive(request):
                      b'\x7FELF' + b'\xFF' * 123456)
         arc.writestr('foo/im.not.really.a.library.so.there',
                      b'blah' * 4096)
+        arc.writestr('foo/tests/_test.cpython-34m-linux_armv7l-linux-gnu.so',
+                     b'\x7FELF' + b'\xFF' * 123456)
         arc.writestr('foo-0.1.dist-info/METADATA', """\
 Metadata-Version: 2.0
 Name: foo
@@ -144,12 +146,25 @@ def test_package_open(mock_package):
     pkg = builder.PiWheelsPackage(path)
     with pkg.open() as f:
         with zipfile.ZipFile(f) as arc:
-            assert len(arc.namelist()) == 4
+            assert len(arc.namelist()) == 5
             assert 'foo-0.1.dist-info/METADATA' in arc.namelist()
             assert 'foo/foo.cpython-34m-linux_armv7l-linux-gnu.so' in arc.namelist()
             assert 'foo/__init__.py' in arc.namelist()
 
 
+def test_package_zip(mock_package):
+    path = Path('/tmp/abc123/foo-0.1-cp34-cp34m-linux_armv7l.whl')
+    pkg = builder.PiWheelsPackage(path)
+    arc = pkg.zip
+    assert 'foo-0.1.dist-info/METADATA' in arc.namelist()
+    # Subsequent accesses re-use the open archive
+    assert pkg.zip is arc
+    pkg.close()
+    assert arc.fp is None
+    assert pkg.zip is not arc
+    pkg.close()
+
+
 def test_package_metadata(mock_package):
     path = Path('/tmp/abc123/foo-0.1-cp34-cp34m-linux_armv7l.whl')
     pkg = builder.PiWheelsPackage(path)
@@ -158,14 +173,27 @@ def test_package_metadata(mock_package):
     assert pkg.metadata['Version'] == '0.1'
 
 
+def test_package_as_message(mock_package):
+    filesize, filehash = mock_package
+    with mock.patch('piwheels.slave.builder.apt'), \
+            mock.patch('piwheels.slave.builder.PiWheelsPackage.'
+                       '_calculate_apt_dependencies') as apt_mock:
+        apt_mock.return_value = {'apt': ['libc6']}
+        path = Path('/tmp/abc123/foo-0.1-cp34-cp34m-linux_armv7l.whl')
+        pkg = builder.PiWheelsPackage(path)
+        assert pkg.as_message() == (
+            'foo-0.1-cp34-cp34m-linux_armv7l.whl', filesize, filehash,
+            'foo', '0.1', 'cp34', 'cp34m', 'linux_armv7l', {'apt': ['libc6']})
+
+
 def test_package_dependencies(mock_package, tmpdir):
-    builder.PiWheelsPackage.apt_cache = None
+    builder.PiWheelsPackage.apt_files = None
     with mock.patch('tempfile.TemporaryDirectory') as tmpdir_mock, \
             mock.patch('piwheels.slave.builder.Popen') as popen_mock, \
             mock.patch('piwheels.slave.builder.Path.resolve', lambda self: self), \
             mock.patch('piwheels.slave.builder.apt') as apt_mock:
         tmpdir_mock().__enter__.return_value = str(tmpdir)
-        popen_mock().communicate.return_value = (b"""\
+        popen_mock().stdout = io.BytesIO(b"""\
         linux-vdso.so.1 =>  (0x00007ffd48669000)
         libblas.so.3 => /usr/lib/libblas.so.3 (0x00007f711a958000)
         libm.so.6 => /lib/arm-linux-gnueabihf/libm.so.6 (0x00007f711a64f000)
@@ -176,7 +204,7 @@ def test_package_dependencies(mock_package, tmpdir):
         libgfortran.so.3 => /usr/lib/arm-linux-gnueabihf/libgfortran.so.3 (0x00007f7117ca9000)
         libquadmath.so.0 => /usr/lib/arm-linux-gnueabihf/libquadmath.so.0 (0x00007f7117a6a000)
         libgcc_s.so.1 => /lib/arm-linux-gnueabihf/libgcc_s.so.1 (0x00007f7117854000)
-""", b"")
+""")
         popen_mock().returncode = 0
         def pkg(name, files):
             m = mock.Mock()
@@ -203,6 +231,55 @@ def test_package_dependencies(mock_package, tmpdir):
             'apt': ['libc6', 'libgcc1', 'libgfortran3', 'libopenblas-base'],
             '': ['/usr/lib/arm-linux-gnueabihf/libquadmath.so.0'],
         }
+        # Only the real (non-test) ELF library is passed to a single ldd
+        # invocation
+        args, kwargs = popen_mock.call_args
+        assert args[0][0] == 'ldd'
+        assert len(args[0]) == 2
+
+
+def test_package_dependencies_conflict(mock_package, tmpdir):
+    builder.PiWheelsPackage.apt_files = None
+    with mock.patch('tempfile.TemporaryDirectory') as tmpdir_mock, \
+            mock.patch('piwheels.slave.builder.Popen') as popen_mock, \
+            mock.patch('piwheels.slave.builder.Path.resolve', lambda self: self), \
+            mock.patch('piwheels.slave.builder.apt') as apt_mock:
+        tmpdir_mock().__enter__.return_value = str(tmpdir)
+        popen_mock().returncode = 0
+        def pkg(name, files):
+            m = mock.Mock()
+            m.name = name
+            m.installed = True
+            m.installed_files = files
+            return m
+        apt_mock.cache.Cache.return_value = [
+            pkg('libc6', [
+                '/lib/arm-linux-gnueabihf/libc.so.6',
+                '/usr/lib/libshared.so.1',
+                '/usr/share/doc/shared',
+            ]),
+            pkg('libopenblas-base', [
+                '/usr/lib/libblas.so.3',
+                '/usr/lib/libshared.so.1',
+                '/usr/share/doc/shared',
+            ]),
+            pkg('libblas3', ['/usr/lib/libblas.so.3']),
+        ]
+        path = Path('/tmp/abc123/foo-0.1-cp34-cp34m-linux_armv7l.whl')
+        # A file claimed by several packages is harmless unless something
+        # depends on it
+        popen_mock().stdout = io.BytesIO(
+            b"libc.so.6 => /lib/arm-linux-gnueabihf/libc.so.6 (0x00007f711a068000)")
+        assert builder.PiWheelsPackage(path).dependencies == {'apt': ['libc6']}
+        # Only shared objects are indexed
+        assert '/usr/share/doc/shared' not in builder.PiWheelsPackage.apt_files
+        assert builder.PiWheelsPackage.apt_conflicts == {
+            '/usr/lib/libshared.so.1', '/usr/lib/libblas.so.3'}
+        popen_mock().stdout = io.BytesIO(
+            b"libblas.so.3 => /usr/lib/libblas.so.3 (0x00007f711a958000)")
+        with pytest.raises(AssertionError):
+            builder.PiWheelsPackage(path).dependencies
+    builder.PiWheelsPackage.apt_files = None
 
 
 def test_package_dependencies_missing(mock_package, tmpdir):
@@ -211,8 +288,8 @@ def test_package_dependencies_missing(mock_package, tmpdir):
             mock.patch('piwheels.slave.builder.Path.resolve', side_effect=FileNotFoundError()), \
             mock.patch('piwheels.slave.builder.apt') as apt_mock:
         tmpdir_mock().__enter__.return_value = str(tmpdir)
-        popen_mock().communicate.return_value = (
-            b"libopenblas.so.0 => /usr/lib/libopenblas.so.0 (0x00007f7117fd4000)", b"")
+        popen_mock().stdout = io.BytesIO(
+            b"libopenblas.so.0 => /usr/lib/libopenblas.so.0 (0x00007f7117fd4000)")
         popen_mock().returncode = 0
         path = Path('/tmp/abc123/foo-0.1-cp34-cp34m-linux_armv7l.whl')
         pkg = builder.PiWheelsPackage(path)
@@ -225,8 +302,8 @@ def test_package_dependencies_cached(mock_package, tmpdir):
             mock.patch('piwheels.slave.builder.Path.resolve', side_effect=FileNotFoundError()), \
             mock.patch('piwheels.slave.builder.apt') as apt_mock:
         tmpdir_mock().__enter__.return_value = str(tmpdir)
-        popen_mock().communicate.return_value = (
-            b"libopenblas.so.0 => /usr/lib/libopenblas.so.0 (0x00007f7117fd4000)", b"")
+        popen_mock().stdout = io.BytesIO(
+            b"libopenblas.so.0 => /usr/lib/libopenblas.so.0 (0x00007f7117fd4000)")
         popen_mock().returncode = 0
         path = Path('/tmp/abc123/foo-0.1-cp34-cp34m-linux_armv7l.whl')
         pkg = builder.PiWheelsPackage(path)
@@ -239,13 +316,74 @@ def test_package_dependencies_cached(mock_package, tmpdir):
 def test_package_dependencies_failed(mock_package, tmpdir):
     with mock.patch('tempfile.TemporaryDirectory') as tmpdir_mock, \
             mock.patch('piwheels.slave.builder.Popen') as popen_mock, \
+            mock.patch('piwheels.slave.builder.Timer') as timer_mock, \
             mock.patch('piwheels.slave.builder.apt') as apt_mock:
         tmpdir_mock().__enter__.return_value = str(tmpdir)
-        popen_mock().communicate.side_effect = [
-            TimeoutExpired('ldd', 10), (b"", b"")]
+        # Simulate ldd being killed by the timeout before producing output
+        popen_mock().stdout = io.BytesIO(b"")
         path = Path('/tmp/abc123/foo-0.1-cp34-cp34m-linux_armv7l.whl')
         pkg = builder.PiWheelsPackage(path)
         assert pkg.dependencies == {}
+        assert timer_mock.call_args == mock.call(60, mock.ANY)
+        # The timer's callback kills the ldd process
+        timer_mock.call_args[0][1]()
+        assert popen_mock().kill.call_count == 1
+        assert timer_mock().cancel.call_count == 1
+        assert popen_mock().wait.call_count == 1
+
+
+def test_package_dependencies_sharded(tmpdir):
+    path = Path(str(tmpdir.join('foo-0.1-cp34-cp34m-linux_armv7l.whl')))
+    with zipfile.ZipFile(str(path), 'w', compression=zipfile.ZIP_STORED) as arc:
+        for name in ('a', 'b', 'c'):
+            arc.writestr('foo/%s.cpython-34m-linux_armv7l-linux-gnu.so' % name,
+                         b'\x7FELF' + b'\xFF' * 1024)
+    with mock.patch('piwheels.slave.builder.os.cpu_count') as cpu_mock, \
+            mock.patch('piwheels.slave.builder.Popen') as popen_mock, \
+            mock.patch('piwheels.slave.builder.Timer') as timer_mock, \
+            mock.patch('piwheels.slave.builder.apt') as apt_mock:
+        cpu_mock.return_value = 2
+        popen_mock.side_effect = lambda *args, **kwargs: mock.Mock(
+            stdout=io.BytesIO(b""))
+        pkg = builder.PiWheelsPackage(path)
+        assert pkg.dependencies == {}
+        assert popen_mock.call_count == 2
+        shards = [args[0] for args, kwargs in popen_mock.call_args_list]
+        assert [shard[0] for shard in shards] == ['ldd', 'ldd']
+        assert sorted(len(shard) for shard in shards) == [2, 3]
+        assert timer_mock.call_count == 1
+
+
+@pytest.mark.parametrize('exc', [PermissionError, KeyboardInterrupt])
+def test_package_dependencies_parse_error(tmpdir, exc):
+    path = Path(str(tmpdir.join('foo-0.1-cp34-cp34m-linux_armv7l.whl')))
+    with zipfile.ZipFile(str(path), 'w', compression=zipfile.ZIP_STORED) as arc:
+        for name in ('a', 'b'):
+            arc.writestr('foo/%s.cpython-34m-linux_armv7l-linux-gnu.so' % name,
+                         b'\x7FELF' + b'\xFF' * 1024)
+    procs = []
+    def popen(*args, **kwargs):
+        procs.append(mock.Mock(returncode=None, stdout=io.BytesIO(
+            b"libblas.so.3 => /usr/lib/libblas.so.3 (0x00007f711a958000)\n")))
+        return procs[-1]
+    with mock.patch('piwheels.slave.builder.os.cpu_count') as cpu_mock, \
+            mock.patch('piwheels.slave.builder.Popen', side_effect=popen), \
+            mock.patch('piwheels.slave.builder.Path.resolve', side_effect=exc()), \
+            mock.patch('piwheels.slave.builder.Timer') as timer_mock, \
+            mock.patch('piwheels.slave.builder.apt') as apt_mock:
+        cpu_mock.return_value = 2
+        pkg = builder.PiWheelsPackage(path)
+        with pytest.raises(exc):
+            pkg.dependencies
+        # Parsing failed in the first shard; every ldd must be killed and its
+        # output closed before waiting for it, or a shard blocked on a full
+        # pipe would never exit
+        assert len(procs) == 2
+        for proc in procs:
+            assert proc.kill.call_count == 1
+            assert proc.stdout.closed
+            assert proc.wait.call_count == 1
+        assert timer_mock().cancel.call_count == 1
 
 
 def test_package_transfer(mock_archive, mock_package, transfer_thread):
@@ -275,14 +413,52 @@ def test_package_transfer_nonsense(mock_archive, mock_package, transfer_thread):
     transfer_thread.send_multipart([b'DONE'])
 
 
+def test_package_transfer_mapped(mock_archive, mock_systemd, zmq_context,
+                                 tmpdir):
+    # The mock_package fixture serves the wheel from a BytesIO which can't be
+    # mapped; use a real file to exercise the mmap path
+    path = Path(str(tmpdir.join('foo-0.1-cp34-cp34m-linux_armv7l.whl')))
+    path.write_bytes(mock_archive)
+    filesize = len(mock_archive)
+    pkg = builder.PiWheelsPackage(path)
+    with zmq_context.socket(transport.DEALER) as server_sock, \
+            zmq_context.socket(transport.DEALER) as client_sock, \
+            mock.patch('piwheels.slave.builder.mmap.mmap',
+                       wraps=builder.mmap.mmap) as mmap_mock:
+        server_sock.bind('inproc://test-transfer-mapped')
+        client_sock.connect('inproc://test-transfer-mapped')
+        client_thread = Thread(target=pkg.transfer, args=(client_sock, 1))
+        client_thread.start()
+        try:
+            assert server_sock.recv_multipart() == [b'HELLO', b'1']
+            server_sock.send_multipart([b'FETCH', b'4096', b'4096'])
+            server_sock.send_multipart([b'FETCH', b'0', b'4096'])
+            server_sock.send_multipart([
+                b'FETCH', b'8192', str(filesize).encode('ascii')])
+            assert server_sock.recv_multipart() == [
+                b'CHUNK', b'4096', mock_archive[4096:8192]]
+            assert server_sock.recv_multipart() == [
+                b'CHUNK', b'0', mock_archive[:4096]]
+            # A FETCH running past the end of the file is truncated to it
+            assert server_sock.recv_multipart() == [
+                b'CHUNK', b'8192', mock_archive[8192:]]
+            server_sock.send_multipart([b'DONE'])
+        finally:
+            client_thread.join(10)
+        assert not client_thread.is_alive()
+        assert mmap_mock.call_count == 1
+
+
 def test_builder_init():
     b = builder.PiWheelsBuilder('foo', '0.1')
+    assert b.staging_dir is None
     assert b.wheel_dir is None
     assert b.package == 'foo'
     assert b.version == '0.1'
     assert b.duration is None
     assert b.output == ''
     assert b.files == []
+    assert b.files_by_name == {}
     assert not b.status
 
 
@@ -293,39 +469,46 @@ def test_builder_as_message():
 
 def test_builder_build_success(mock_archive, mock_systemd, tmpdir):
     with mock.patch('tempfile.TemporaryDirectory') as tmpdir_mock, \
-            mock.patch('piwheels.slave.builder.Popen') as popen_mock:
+            mock.patch('piwheels.slave.builder.Popen') as popen_mock, \
+            mock.patch('piwheels.slave.builder.apt', None):
         tmpdir_mock().name = str(tmpdir)
         def wait(timeout):
             with tmpdir.join('foo-0.1-cp34-cp34m-linux_armv7l.whl').open('wb') as f:
                 f.write(mock_archive)
         popen_mock().wait.side_effect = wait
         popen_mock().returncode = 0
-        b = builder.PiWheelsBuilder('foo', '0.1')
+        b = builder.PiWheelsBuilder('foo', '0.1', '/var/tmp/piw-stage-foo')
         b.build()
         assert b.status
+        assert tmpdir_mock.call_args == mock.call(dir='/var/tmp/piw-stage-foo')
         args, kwargs = popen_mock.call_args
         assert args[0][-1] == 'foo==0.1'
         assert len(b.files) == 1
         assert b.files[0].filename == 'foo-0.1-cp34-cp34m-linux_armv7l.whl'
+        assert b.files_by_name == {
+            'foo-0.1-cp34-cp34m-linux_armv7l.whl': b.files[0]}
+        assert len(b._pending) == 2
+        msg = b.as_message()
+        assert all(future.done() for future in b._pending)
+        assert msg[-1] == [b.files[0].as_message()]
 
 
 def test_builder_build_timeout(mock_systemd, tmpdir):
     with mock.patch('tempfile.TemporaryDirectory') as tmpdir_mock, \
             mock.patch('piwheels.slave.builder.Popen') as popen_mock, \
-            mock.patch('piwheels.slave.builder.datetime') as time_mock:
+            mock.patch('piwheels.slave.builder.monotonic') as time_mock:
         tmpdir_mock().name = str(tmpdir)
         popen_mock().wait.side_effect = TimeoutExpired('pip3', 300)
         popen_mock().returncode = -9
-        now = datetime.utcnow()
-        time_mock.utcnow.side_effect = [
-            now, now + timedelta(seconds=100), now + timedelta(seconds=1000),
-            now + timedelta(seconds=1001)]
+        time_mock.side_effect = [0.0, 100.0, 1000.0, 1001.0]
         b = builder.PiWheelsBuilder('foo', '0.1')
         b.build()
         assert not b.status
+        assert b.duration == timedelta(seconds=1001)
         args, kwargs = popen_mock.call_args
         assert args[0][-1] == 'foo==0.1'
         assert len(b.files) == 0
+        assert popen_mock().wait.call_args_list == [mock.call(60), mock.call(10)]
         assert popen_mock().terminate.call_count == 1
         assert popen_mock().kill.call_count == 1
 
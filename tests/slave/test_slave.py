@@ -28,7 +28,8 @@
 
 
 import os
-import pickle
+import random
+import faulthandler
 from unittest import mock
 from threading import Thread
 from subprocess import DEVNULL
@@ -36,42 +37,181 @@ from itertools import chain, cycle
 
 import pytest
 
-from conftest import find_message
 from piwheels import __version__, protocols, transport
-from piwheels.slave import PiWheelsSlave, MasterTimeout
-
-
+from piwheels.slave import PiWheelsSlave
+
+
+# Every wait in this module is expected to complete almost instantly; this
+# bounds how long a broken test can hang before failing. The environment
+# variable can be used to extend it on particularly slow machines
+FAST_TIMEOUT = float(os.environ.get('PIWHEELS_TEST_TIMEOUT', '2.0'))
+
+# The pip command line expected when the slave is asked to build foo 1.0
+EXPECTED_PIP_CALL = mock.call([
+    'pip3', 'wheel', '--index-url=https://pypi.org/pypi',
+    mock.ANY, mock.ANY, '--no-deps', '--no-cache-dir',
+    '--exists-action=w', '--disable-pip-version-check',
+    'foo==1.0'],
+    stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, env=mock.ANY
+)
+
+
+def recv_expect(queue, expected, timeout=FAST_TIMEOUT):
+    assert queue.poll(timeout), 'timed out waiting for %s' % expected
+    # The poll guarantees a message is waiting, so there's no need for the
+    # (second) poll a blocking receive would perform
+    addr, msg, data = queue.recv_addr_msg(transport.NOBLOCK)
+    assert msg == expected, 'expected %s but got %s %r' % (expected, msg, data)
+    return addr, data
+
+
+def drive_handshake(queue, exchanges=()):
+    """
+    Drive the slave on the other end of *queue* through HELLO and ACK, then
+    send each (msg, data, expected) tuple in *exchanges* in turn, checking the
+    slave replies with *expected* to each, before finally sending DIE and
+    expecting BYE. Returns the list of data from the slave's replies to
+    *exchanges*.
+    """
+    addr, data = recv_expect(queue, 'HELLO')
+    queue.send_addr_msg(addr, 'ACK', [1, 'https://pypi.org/pypi'])
+    addr, data = recv_expect(queue, 'IDLE')
+    replies = []
+    for msg, data, expected in exchanges:
+        queue.send_addr_msg(addr, msg, data)
+        addr, data = recv_expect(queue, expected)
+        replies.append(data)
+    queue.send_addr_msg(addr, 'DIE')
+    recv_expect(queue, 'BYE')
+    return replies
+
+
+def join_thread(thread, timeout=FAST_TIMEOUT):
+    thread.join(timeout)
+    if thread.is_alive():
+        # Dump the stacks of all threads to show where the slave is stuck
+        faulthandler.dump_traceback()
+    assert not thread.is_alive()
+
+
+# Every test gets its own in-process endpoints (see slave_queue_name and
+# file_queue_name in conftest) so the module is safe to run in parallel with
+# pytest-xdist, e.g. py.test -n auto tests/slave
 @pytest.fixture()
-def mock_slave_driver(request, zmq_context, tmpdir):
+def mock_slave_driver(request, zmq_context, slave_queue_name):
     queue = zmq_context.socket(
         transport.ROUTER, protocol=protocols.slave_driver)
     queue.hwm = 1
-    queue.bind('ipc://' + str(tmpdir.join('slave-driver-queue')))
+    queue.bind(slave_queue_name)
     yield queue
     queue.close()
 
 
 @pytest.fixture()
-def mock_file_juggler(request, zmq_context, tmpdir):
+def mock_file_juggler(request, zmq_context, file_queue_name):
     queue = zmq_context.socket(
         transport.DEALER, protocol=protocols.file_juggler)
     queue.hwm = 1
-    queue.bind('ipc://' + str(tmpdir.join('file-juggler-queue')))
+    queue.bind(file_queue_name)
     yield queue
     queue.close()
 
 
+class FakePopen:
+    """
+    A minimal stand-in for :class:`subprocess.Popen` which is far cheaper to
+    construct than a :class:`~unittest.mock.MagicMock`. Every construction is
+    recorded (as a :func:`~unittest.mock.call`) in the *calls* list.
+    """
+    returncode = 0
+    calls = None
+
+    def __init__(self, *args, **kwargs):
+        self.calls.append(mock.call(*args, **kwargs))
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+    def terminate(self):
+        pass
+
+    def kill(self):
+        pass
+
+
+class FakeTemporaryDirectory:
+    """
+    A stand-in for :class:`tempfile.TemporaryDirectory` which always "creates"
+    the same *name*, recording the keyword arguments of each construction in
+    *calls* and the number of times :meth:`cleanup` is called in *cleaned*.
+    """
+    name = None
+    calls = None
+    cleaned = 0
+
+    def __init__(self, **kwargs):
+        self.calls.append(kwargs)
+
+    def cleanup(self):
+        type(self).cleaned += 1
+
+
 @pytest.fixture()
-def mock_signal(request):
-    with mock.patch('signal.signal') as signal:
-        yield signal
+def fake_popen(request, monkeypatch):
+    popen = type('FakePopen', (FakePopen,), {'calls': []})
+    monkeypatch.setattr('piwheels.slave.builder.Popen', popen)
+    yield popen
 
 
 @pytest.fixture()
-def slave_thread(request, mock_context, mock_systemd, mock_signal, tmpdir):
-    main = PiWheelsSlave()
+def fake_tempdir(request, monkeypatch, tmp_path):
+    tempdir = type('FakeTemporaryDirectory', (FakeTemporaryDirectory,), {
+        'name': str(tmp_path), 'calls': []})
+    monkeypatch.setattr('tempfile.TemporaryDirectory', tempdir)
+    yield tempdir
+
+
+class FakeClock:
+    """
+    A clock for :class:`PiWheelsSlave` which returns successive values from
+    the *times* iterator; tests can replace *times* to move time forward.
+    """
+    def __init__(self):
+        self.times = cycle([1.0])
+
+    def __call__(self):
+        return next(self.times)
+
+
+@pytest.fixture()
+def fake_clock(request):
+    yield FakeClock()
+
+
+@pytest.fixture()
+def log_messages(request, caplog):
+    # Returns a function which produces the set of messages logged so far,
+    # for simple membership tests
+    yield lambda: {record.getMessage() for record in caplog.records}
+
+
+@pytest.fixture()
+def mock_signal(request, monkeypatch):
+    handlers = {}
+    monkeypatch.setattr('signal.signal', handlers.__setitem__)
+    yield handlers
+
+
+@pytest.fixture()
+def slave_thread(request, mock_context, mock_systemd, mock_signal, fake_clock):
+    main = PiWheelsSlave(clock=fake_clock)
     slave_thread = Thread(daemon=True, target=main, args=([],))
     yield slave_thread
+    # The context is shared by the whole session, so make sure a slave that
+    # has exited cleaned up all its sockets rather than leaving them around
+    # for later tests
+    if not slave_thread.is_alive():
+        assert all(sock._socket.closed for sock in mock_context.sockets)
 
 
 def test_help(capsys):
@@ -91,195 +231,152 @@ def test_version(capsys):
     assert out.strip() == __version__
 
 
-def test_no_root(caplog):
+def test_parser_cached():
+    parser = PiWheelsSlave.get_parser()
+    assert PiWheelsSlave().get_parser() is parser
+
+
+def test_no_root(monkeypatch, log_messages):
     main = PiWheelsSlave()
-    with mock.patch('os.geteuid') as geteuid:
-        geteuid.return_value = 0
-        assert main([]) != 0
-    assert find_message(caplog.records, message='Slave must not be run as root')
+    monkeypatch.setattr('os.geteuid', lambda: 0)
+    assert main([]) != 0
+    assert 'Slave must not be run as root' in log_messages()
 
 
-def test_system_exit(mock_systemd, slave_thread, mock_slave_driver):
-    with mock.patch('piwheels.slave.PiWheelsSlave.main_loop') as main_loop:
-        main_loop.side_effect = SystemExit(1)
-        slave_thread.start()
-        assert mock_systemd._ready.wait(10)
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'BYE'
-        slave_thread.join(10)
-        assert not slave_thread.is_alive()
+def test_no_openssl(monkeypatch, log_messages):
+    def sha256(data=b''):
+        assert False, 'hashing should not be attempted'
+    main = PiWheelsSlave()
+    monkeypatch.setattr('os.geteuid', lambda: 0)
+    monkeypatch.setattr('hashlib.sha256', sha256)
+    assert main([]) != 0
+    assert ('hashlib is not backed by OpenSSL; wheel hashing will be slow'
+            in log_messages())
+
+
+def test_system_exit(mock_systemd, slave_thread, mock_slave_driver,
+                     monkeypatch):
+    def main_loop(self, queue, timeout=300):
+        raise SystemExit(1)
+    monkeypatch.setattr(PiWheelsSlave, 'main_loop', main_loop)
+    slave_thread.start()
+    assert mock_systemd._ready.wait(FAST_TIMEOUT)
+    addr, data = recv_expect(mock_slave_driver, 'BYE')
+    join_thread(slave_thread)
 
 
 def test_bye_exit(mock_systemd, slave_thread, mock_slave_driver):
     slave_thread.start()
-    assert mock_systemd._ready.wait(10)
-    addr, msg, data = mock_slave_driver.recv_addr_msg()
-    assert msg == 'HELLO'
+    assert mock_systemd._ready.wait(FAST_TIMEOUT)
+    addr, data = recv_expect(mock_slave_driver, 'HELLO')
     mock_slave_driver.send_addr_msg(addr, 'DIE')
-    addr, msg, data = mock_slave_driver.recv_addr_msg()
-    assert msg == 'BYE'
-    slave_thread.join(10)
-    assert not slave_thread.is_alive()
-
-
-def test_connection_timeout(mock_systemd, slave_thread, mock_slave_driver, caplog):
-    with mock.patch('piwheels.slave.time') as time_mock:
-        time_mock.side_effect = chain([1.0, 401.0, 402.0], cycle([403.0]))
-        slave_thread.start()
-        assert mock_systemd._ready.wait(10)
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'HELLO'
-        # Allow timeout (time_mock takes care of faking this)
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'HELLO'
-        mock_slave_driver.send_addr_msg(addr, 'DIE')
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'BYE'
-        slave_thread.join(10)
-        assert not slave_thread.is_alive()
-    assert find_message(caplog.records, message='Timed out waiting for master')
+    addr, data = recv_expect(mock_slave_driver, 'BYE')
+    join_thread(slave_thread)
 
 
 def test_bad_message_exit(mock_systemd, slave_thread, mock_slave_driver):
     slave_thread.start()
-    assert mock_systemd._ready.wait(10)
-    addr, msg, data = mock_slave_driver.recv_addr_msg()
-    assert msg == 'HELLO'
+    assert mock_systemd._ready.wait(FAST_TIMEOUT)
+    addr, data = recv_expect(mock_slave_driver, 'HELLO')
     mock_slave_driver.send_multipart([addr, b'', b'FOO'])
-    addr, msg, data = mock_slave_driver.recv_addr_msg()
-    assert msg == 'BYE'
-    slave_thread.join(10)
-    assert not slave_thread.is_alive()
+    addr, data = recv_expect(mock_slave_driver, 'BYE')
+    join_thread(slave_thread)
 
 
 def test_hello(mock_systemd, slave_thread, mock_slave_driver):
     slave_thread.start()
-    assert mock_systemd._ready.wait(10)
-    addr, msg, data = mock_slave_driver.recv_addr_msg()
-    assert msg == 'HELLO'
-    mock_slave_driver.send_addr_msg(addr, 'ACK', [1, 'https://pypi.org/pypi'])
-    addr, msg, data = mock_slave_driver.recv_addr_msg()
-    assert msg == 'IDLE'
-    mock_slave_driver.send_addr_msg(addr, 'DIE')
-    addr, msg, data = mock_slave_driver.recv_addr_msg()
-    assert msg == 'BYE'
-    slave_thread.join(10)
-    assert not slave_thread.is_alive()
-
-
-def test_sleep(mock_systemd, slave_thread, mock_slave_driver):
-    with mock.patch('piwheels.slave.randint', return_value=0):
-        slave_thread.start()
-        assert mock_systemd._ready.wait(10)
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'HELLO'
-        mock_slave_driver.send_addr_msg(addr, 'ACK', [1, 'https://pypi.org/pypi'])
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'IDLE'
-        mock_slave_driver.send_addr_msg(addr, 'SLEEP')
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'IDLE'
-        mock_slave_driver.send_addr_msg(addr, 'DIE')
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'BYE'
-        slave_thread.join(10)
-        assert not slave_thread.is_alive()
-
-
-def test_slave_build_failed(mock_systemd, slave_thread, mock_slave_driver, caplog):
-    with mock.patch('piwheels.slave.builder.Popen') as popen_mock:
-        popen_mock().returncode = 1
-        slave_thread.start()
-        assert mock_systemd._ready.wait(10)
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'HELLO'
-        mock_slave_driver.send_addr_msg(addr, 'ACK', [1, 'https://pypi.org/pypi'])
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'IDLE'
-        mock_slave_driver.send_addr_msg(addr, 'BUILD', ['foo', '1.0'])
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'BUILT'
-        assert popen_mock.call_args == mock.call([
-            'pip3', 'wheel', '--index-url=https://pypi.org/pypi',
-            mock.ANY, mock.ANY, '--no-deps', '--no-cache-dir',
-            '--exists-action=w', '--disable-pip-version-check',
-            'foo==1.0'],
-            stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, env=mock.ANY
-        )
-        mock_slave_driver.send_addr_msg(addr, 'DIE')
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'BYE'
-        slave_thread.join(10)
-        assert not slave_thread.is_alive()
-    assert find_message(caplog.records, message='Build failed')
-
-
-def test_connection_timeout_with_build(mock_systemd, slave_thread, mock_slave_driver, caplog):
-    with mock.patch('piwheels.slave.builder.Popen') as popen_mock, \
-            mock.patch('piwheels.slave.time') as time_mock:
-        time_mock.side_effect = cycle([1.0])
-        slave_thread.start()
-        assert mock_systemd._ready.wait(10)
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'HELLO'
-        mock_slave_driver.send_addr_msg(addr, 'ACK', [1, 'https://pypi.org/pypi'])
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'IDLE'
-        mock_slave_driver.send_addr_msg(addr, 'BUILD', ['foo', '1.0'])
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'BUILT'
-        time_mock.side_effect = chain([400.0], cycle([800.0]))
-        # Allow timeout (time_mock takes care of faking this)
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'HELLO'
-        mock_slave_driver.send_addr_msg(addr, 'DIE')
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'BYE'
-        slave_thread.join(10)
-        assert not slave_thread.is_alive()
-    assert find_message(caplog.records, message='Build failed')
-    assert find_message(caplog.records, message='Timed out waiting for master')
-
-
-def test_slave_build_send_done(mock_systemd, slave_thread, mock_slave_driver, tmpdir, caplog):
-    with mock.patch('piwheels.slave.builder.Popen') as popen_mock, \
-            mock.patch('piwheels.slave.builder.PiWheelsPackage._calculate_apt_dependencies') as apt_mock, \
-            mock.patch('piwheels.slave.builder.PiWheelsPackage.transfer') as transfer_mock, \
-            mock.patch('piwheels.slave.builder.tempfile.TemporaryDirectory') as tmpdir_mock:
-        popen_mock().returncode = 0
-        apt_mock.return_value = {}
-        tmpdir_mock().name = str(tmpdir)
-        tmpdir.join('foo-0.1-cp34-cp34m-linux_armv7l.whl').ensure()
-        slave_thread.start()
-        assert mock_systemd._ready.wait(10)
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'HELLO'
+    assert mock_systemd._ready.wait(FAST_TIMEOUT)
+    drive_handshake(mock_slave_driver)
+    join_thread(slave_thread)
+
+
+def test_sleep():
+    # Individual replies can be driven synchronously through handle_reply
+    # without starting a thread or connecting a queue; the end-to-end tests
+    # above already cover main_loop's dispatching to it
+    sleeps = []
+    main = PiWheelsSlave(sleep=sleeps.append, rng=random.Random(0))
+    assert main.handle_reply('ACK', [1, 'https://pypi.org/pypi']) == (
+        'IDLE', protocols.NoData)
+    assert main.handle_reply('SLEEP', protocols.NoData) == (
+        'IDLE', protocols.NoData)
+    assert sleeps == [random.Random(0).randint(5, 15)]
+
+
+def test_slave_build_failed(mock_systemd, slave_thread, mock_slave_driver,
+                            fake_popen, log_messages):
+    fake_popen.returncode = 1
+    slave_thread.start()
+    assert mock_systemd._ready.wait(FAST_TIMEOUT)
+    drive_handshake(mock_slave_driver, [('BUILD', ['foo', '1.0'], 'BUILT')])
+    join_thread(slave_thread)
+    assert fake_popen.calls == [EXPECTED_PIP_CALL]
+    assert 'Build failed' in log_messages()
+
+
+@pytest.mark.parametrize('with_build', [False, True])
+def test_connection_timeout(mock_systemd, slave_thread, mock_slave_driver,
+                            fake_popen, fake_clock, monkeypatch, log_messages,
+                            with_build):
+    platforms = []
+    def get_platform():
+        platforms.append('linux_armv7l')
+        return platforms[-1]
+    fake_popen.returncode = 1
+    monkeypatch.setattr('piwheels.slave.pep425tags.get_platform', get_platform)
+    slave_thread.start()
+    assert mock_systemd._ready.wait(FAST_TIMEOUT)
+    addr, data = recv_expect(mock_slave_driver, 'HELLO')
+    assert data[3] == 'linux_armv7l'
+    if with_build:
         mock_slave_driver.send_addr_msg(addr, 'ACK', [1, 'https://pypi.org/pypi'])
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'IDLE'
+        addr, data = recv_expect(mock_slave_driver, 'IDLE')
         mock_slave_driver.send_addr_msg(addr, 'BUILD', ['foo', '1.0'])
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'BUILT'
-        assert popen_mock.call_args == mock.call([
-            'pip3', 'wheel', '--index-url=https://pypi.org/pypi',
-            mock.ANY, mock.ANY, '--no-deps', '--no-cache-dir',
-            '--exists-action=w', '--disable-pip-version-check',
-            'foo==1.0'],
-            stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, env=mock.ANY
-        )
-        mock_slave_driver.send_addr_msg(addr, 'SEND', 'foo-0.1-cp34-cp34m-linux_armv7l.whl')
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'SENT'
-        mock_slave_driver.send_addr_msg(addr, 'DONE')
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'IDLE'
-        mock_slave_driver.send_addr_msg(addr, 'DIE')
-        addr, msg, data = mock_slave_driver.recv_addr_msg()
-        assert msg == 'BYE'
-        slave_thread.join(10)
-        assert not slave_thread.is_alive()
-    assert find_message(caplog.records, message='Build succeeded')
-    assert find_message(caplog.records,
-                        message='Sending foo-0.1-cp34-cp34m-linux_armv7l.whl '
-                        'to master on localhost')
-    assert find_message(caplog.records, message='Removing temporary build directories')
+        addr, data = recv_expect(mock_slave_driver, 'BUILT')
+    # Allow timeout (fake_clock takes care of faking this)
+    fake_clock.times = chain([400.0], cycle([800.0]))
+    addr, data = recv_expect(mock_slave_driver, 'HELLO')
+    assert data[3] == 'linux_armv7l'
+    # The tags are only calculated once, not on every re-connection
+    assert len(platforms) == 1
+    mock_slave_driver.send_addr_msg(addr, 'DIE')
+    addr, data = recv_expect(mock_slave_driver, 'BYE')
+    join_thread(slave_thread)
+    messages = log_messages()
+    if with_build:
+        assert fake_popen.calls == [EXPECTED_PIP_CALL]
+        assert 'Build failed' in messages
+    assert 'Timed out waiting for master' in messages
+
+
+def test_slave_build_send_done(mock_systemd, slave_thread, mock_slave_driver,
+                               fake_popen, fake_tempdir, tmp_path,
+                               monkeypatch, log_messages):
+    transfers = []
+    def transfer(self, queue, slave_id):
+        transfers.append((self.filename, slave_id))
+    monkeypatch.setattr(
+        'piwheels.slave.builder.PiWheelsPackage._calculate_apt_dependencies',
+        lambda self: {})
+    monkeypatch.setattr(
+        'piwheels.slave.builder.PiWheelsPackage.transfer', transfer)
+    (tmp_path / 'foo-0.1-cp34-cp34m-linux_armv7l.whl').touch()
+    slave_thread.start()
+    assert mock_systemd._ready.wait(FAST_TIMEOUT)
+    drive_handshake(mock_slave_driver, [
+        ('BUILD', ['foo', '1.0'], 'BUILT'),
+        ('SEND', 'foo-0.1-cp34-cp34m-linux_armv7l.whl', 'SENT'),
+        ('DONE', protocols.NoData, 'IDLE'),
+    ])
+    join_thread(slave_thread)
+    # The build is staged within the slave's staging directory
+    assert fake_tempdir.calls == [
+        {'prefix': 'piw-stage-'}, {'dir': str(tmp_path)}]
+    assert fake_tempdir.cleaned == 2
+    assert fake_popen.calls == [EXPECTED_PIP_CALL]
+    assert transfers == [('foo-0.1-cp34-cp34m-linux_armv7l.whl', 1)]
+    messages = log_messages()
+    assert 'Build succeeded' in messages
+    assert ('Sending foo-0.1-cp34-cp34m-linux_armv7l.whl to master on '
+            'localhost' in messages)
+    assert 'Removing temporary build directories' in messages
@@ -204,3 +204,16 @@ def test_hwm_attr():
     sock = ctx.socket(PULL)
     sock.hwm = 10
     assert sock.hwm == 10
+
+
+def test_send_multipart_nocopy():
+    ctx = Context()
+    pull = ctx.socket(PULL)
+    push = ctx.socket(PUSH)
+    pull.bind('inproc://foo')
+    push.connect('inproc://foo')
+    data = b'\x00' * 123456
+    push.send_multipart([b'FOO', data], copy=False)
+    assert pull.recv_multipart() == [b'FOO', data]
+    push.close()
+    pull.close()